@@ -97,7 +97,7 @@ class LisfloodModel_ini(DynamicModel):
         flags = self.settings.flags
         report_steps = self.settings.report_steps
 
-        # set the maximum number of threads that numba should use (now used in soilloop only)
+        # set the maximum number of threads that numba should use (used in soilloop and riceirrigation)
         num_threads = int(binding["numCPUs_parallelNumba"])
         if (num_threads>0):
             if num_threads<=numba_config.NUMBA_NUM_THREADS:
@@ -17,13 +17,111 @@ See the Licence for the specific language governing permissions and limitations
 from __future__ import absolute_import, print_function
 
 import numpy as np
+from numba import njit, prange
 
 from lisflood.global_modules.errors import LisfloodError
 
-from ..global_modules.add1 import loadmap
+from ..global_modules.add1 import loadmap, makenumpy
 from ..global_modules.settings import MaskInfo, LisSettings
 from . import HydroModule
 
+# paddy rice phases, as bit flags in the phase calendar (see phase_calendar)
+SOIL_SATURATION, FLOODING, GROWING, DRAINAGE = 1, 2, 4, 8
+
+
+@njit(parallel=True, fastmath=False, cache=True)
+def paddy_rice_water_balance(rice_pixels, phases, WS1, W1, WFC1, EWRef, ESAct, Ta,
+                             RiceMMtoM3, RiceMMtoM3Dt, RiceFloodingDemandM3, RicePercolationDemandM3,
+                             M3toMM, SoilFraction, PaddyRiceWaterAbstractionFromSurfaceWaterM3, UZ):
+    """ paddy rice water abstraction [m3 per time interval] and drainage to the upper zone, in a single pass over the
+        pixels with paddy rice (rice_pixels): every term is proportional to the rice fraction, so other pixels are left untouched.
+        phases holds the phase flags of each rice pixel for the current day (a row of the phase calendar)
+
+        water needed for paddy rice is assumed to consist of:
+        phase 1: field preparation: soil saturation (assumed to happen in 10 days, 20 days before planting)
+        phase 2: flood fields (assumed to happen in 10 days, 10 days before planting)
+        phase 3: planting, while keep constant water level during growing season (open water evaporation)
+        phase 4: stop keeping constant water level 20 days before harvest date
+        phase 5: start draining 10 days before harvest date
+    """
+    for i in prange(rice_pixels.size):
+        pix = rice_pixels[i]
+        # phase 1: field preparation: soil saturation
+        # EDITED on Jan 15th 2022: saturation demand is computed considering only soil layers 1a and 1b (NO 2)
+        # this part is using the whole other fraction to calculate the demand -> an rice only soil part is needed
+        if (phases[i] & SOIL_SATURATION) != 0:
+            RiceSoilSaturationM3 = (WS1[pix] - W1[pix]) * RiceMMtoM3Dt[pix] * 0.1
+        else:
+            RiceSoilSaturationM3 = 0.
+
+        is_flooding = (phases[i] & FLOODING) != 0
+        is_growing = (phases[i] & GROWING) != 0
+        # open water evaporation is only needed in phases 2 and 3
+        if is_flooding or is_growing:
+            # substracting the soil evaporation and transpiration which was already taken off in the soil module
+            # should not happen, but just to be sure that this doesnt go <0
+            # (max with a float literal compiles to a branchless maxsd, no fastmath needed)
+            RiceEvaporationDemandM3 = max(EWRef[pix] - (ESAct[pix] + Ta[pix]), 0.) * RiceMMtoM3[pix]
+        else:
+            RiceEvaporationDemandM3 = 0.
+
+        # phase 2: flood fields
+        # assumption is that a fixed water layer is kept on the rice fields, totalling RiceFlooding*10 in mmm (typically 50 or 100 mm)
+        # application is spread out over 10 days, open water evaporation at the same time
+        if is_flooding:
+            RiceFloodingM3 = RiceFloodingDemandM3[pix] + RiceEvaporationDemandM3
+        else:
+            RiceFloodingM3 = 0.
+
+        # phase 3: planting, while keep constant water level during growing season (open water evaporation)
+        # FAO: percolation for heavy clay soils: PERC = 2 mm/day
+        if is_growing:
+            RiceEvaporationM3 = RiceEvaporationDemandM3
+            RicePercolationM3 = RicePercolationDemandM3[pix]
+        else:
+            RiceEvaporationM3 = 0.
+            RicePercolationM3 = 0.
+
+        PaddyRiceWaterAbstractionFromSurfaceWaterM3[pix] = RiceSoilSaturationM3 + RiceFloodingM3 + RiceEvaporationM3 + RicePercolationM3
+
+        # phase 4: stop keeping constant water level 20 days before harvest date
+        # phase 5: start draining 10 days before harvest date
+        # EDITED on January 15th 2022: DRAINAGE from layers 1a and 1b (NO 2)
+        # drainage until FC to soil/groundwater at end of season
+        # assumption that the last weeks before harvest the 50mm water layer is completely evaporating
+        # needs to be transported to channel system or being drained
+        is_draining = (phases[i] & DRAINAGE) != 0
+        if is_draining:
+            RiceDrainageM3 = (WS1[pix] - WFC1[pix]) * RiceMMtoM3Dt[pix] * 0.1
+        else:
+            RiceDrainageM3 = 0.
+
+        # drained and percolated water is added to the upper zone: UZ is only read and written
+        # for pixels in phase 3 or 5, where there is something to add
+        if (is_growing or is_draining) and SoilFraction[pix] > 0.:
+            UZ[pix] += (RiceDrainageM3 + RicePercolationM3) * M3toMM[pix] / SoilFraction[pix]
+
+
+def phase_calendar(pixels, RiceSoilSaturationDay1, RiceFloodingDay1, RicePlantingDay1,
+                   RiceGrowingEndDay1, RiceDrainageDay1, RiceHarvestDay1):
+    """ paddy rice phases of the given pixels for each day of the year (0 to 366), as bit flags: array[day, pixel]
+        phase 1: soil saturation, from 20 to 10 days before planting
+        phase 2: flooding, from 10 days before planting to planting
+        phase 3 (and 4): growing season at constant water level, from planting to 20 days before harvest
+        phase 5: drainage, from 10 days before harvest to harvest
+    """
+    # for Europe ok, but for Global planting can be on the 330 and harvest on the 90, so harvest < planting
+    # or riceplanting = 5 => riceplanting -20 =350 ==> riceplanting < riceplanting -20
+    # (such windows are empty: days are compared without wrapping around the end of the year)
+    day = np.arange(367, dtype=np.float32)[:, np.newaxis]
+    calendar = np.zeros((367, pixels.size), dtype=np.uint8)
+    for flag, lower, upper in ((SOIL_SATURATION, RiceSoilSaturationDay1, RiceFloodingDay1),
+                               (FLOODING, RiceFloodingDay1, RicePlantingDay1),
+                               (GROWING, RicePlantingDay1, RiceGrowingEndDay1),
+                               (DRAINAGE, RiceDrainageDay1, RiceHarvestDay1)):
+        calendar[(lower[pixels] <= day) & (day < upper[pixels])] |= flag
+    return calendar
+
 
 class riceirrigation(HydroModule):
     """
@@ -46,6 +144,10 @@ class riceirrigation(HydroModule):
         """
         maskinfo = MaskInfo.instance()
         self.var.PaddyRiceWaterAbstractionFromSurfaceWaterM3 = maskinfo.in_zero()
+        self.paddy_rice_abstraction = self.var.PaddyRiceWaterAbstractionFromSurfaceWaterM3
+        # output buffer owned by the module, overwritten in place at every time step
+        self.paddy_rice_active = False
+        # True if the buffer holds the abstraction of an active day (see dynamic)
         settings = LisSettings.instance()
         option = settings.options
         if option['riceIrrigation']:
@@ -59,15 +161,21 @@ class riceirrigation(HydroModule):
             # ***** PADDY RICE IRRIGATION AND ABSTRACTION ******************
             # ************************************************************
 
+            veg = "Rainfed_prescribed" # ONCE RICE IS SIMULATED IN EPIC, THIS MODULE SHOULD BE SKIPPED WHEN EPIC IS ON!
+            self.iveg, self.ilanduse, _ = self.var.get_landuse_and_indexes_from_vegetation_GLOBAL(veg)
+            # vegetation and land use indexes of paddy rice, fixed for the whole run
+
             # Additional water for paddy rice cultivation is calculated seperately, as well as additional open water evaporation from rice fields
             self.var.RiceFlooding = loadmap('RiceFlooding')
             # 10 mm for 10 days (total 10cm water)
             self.var.RicePercolation = loadmap('RicePercolation')
             # FAO: percolation for heavy clay soils: PERC = 2 mm/day
 
-            self.var.RicePlantingDay1 = loadmap('RicePlantingDay1')
+            # days of the year are whole numbers, exactly represented in single precision (float32 is enough
+            # for them and for the phase boundaries below); constant settings are expanded to maps
+            self.var.RicePlantingDay1 = makenumpy(loadmap('RicePlantingDay1')).astype(np.float32)
             # starting day (of the year) of first rice planting
-            self.var.RiceHarvestDay1 = loadmap('RiceHarvestDay1')
+            self.var.RiceHarvestDay1 = makenumpy(loadmap('RiceHarvestDay1')).astype(np.float32)
             # starting day (of the year) of first rice harvest
 
             self.var.RicePlantingDay2 = loadmap('RicePlantingDay2')
@@ -75,106 +183,90 @@ class riceirrigation(HydroModule):
             self.var.RiceHarvestDay2 = loadmap('RiceHarvestDay2')
             # starting day (of the year) of 2nd rice harvest
 
+            # phase boundaries depend only on planting and harvest days: computed once here
+            # days before the 1st of January wrap to the end of the previous year (same as 365 + day where day < 0)
+            self.var.RiceSoilSaturationDay1 = (self.var.RicePlantingDay1 - 20) % 365
+            # starting day (of the year) of soil saturation, 20 days before planting
+            self.var.RiceFloodingDay1 = (self.var.RicePlantingDay1 - 10) % 365
+            # starting day (of the year) of field flooding, 10 days before planting
+            self.var.RiceGrowingEndDay1 = (self.var.RiceHarvestDay1 - 20) % 365
+            # last day (of the year, excluded) of constant water level, 20 days before harvest
+            self.var.RiceDrainageDay1 = (self.var.RiceHarvestDay1 - 10) % 365
+            # starting day (of the year) of drainage, 10 days before harvest
+            self.rice_fraction = None
+            # RiceFraction the area factors below were computed for (see update_rice_area)
+            self.rice_pixels = None
+            # pixels the phase calendar was built for (see update_rice_pixels)
+
+    def update_rice_area(self):
+        """ per-pixel factors of the rice fraction
+            called whenever the RiceFraction array is replaced: with transient land use change this happens at every
+            time step, so the factors are only recomputed when the rice fraction values actually differ
+        """
+        unchanged = self.rice_fraction is not None and np.array_equal(self.var.RiceFraction, self.rice_fraction)
+        self.rice_fraction = self.var.RiceFraction
+        if unchanged:
+            return
+        rice_pixels = np.flatnonzero(self.var.RiceFraction > 0)
+        if self.rice_pixels is None or not np.array_equal(rice_pixels, self.rice_pixels):
+            self.update_rice_pixels(rice_pixels)
+        self.var.RiceMMtoM3 = self.var.RiceFraction * self.var.MMtoM3
+        # m3 of water per mm over the rice fraction of the pixel
+        self.var.RiceMMtoM3Dt = self.var.RiceMMtoM3 * self.var.DtDay
+        # m3 per time interval per mm/day over the rice fraction of the pixel
+        self.var.RiceFloodingDemandM3 = self.var.RiceFlooding * self.var.RiceMMtoM3Dt
+        self.var.RicePercolationDemandM3 = self.var.RicePercolation * self.var.RiceMMtoM3Dt
+        # m3 per time interval
+
+    def update_rice_pixels(self, rice_pixels):
+        """ phase calendar of the pixels with paddy rice
+            it only depends on the static planting/harvest days and on which pixels have rice, so it is rebuilt
+            only when that set of pixels changes, not when the rice fraction values do
+        """
+        self.rice_pixels = rice_pixels
+        # pixels with paddy rice, the only ones processed in dynamic
+        self.phase_calendar = phase_calendar(self.rice_pixels, self.var.RiceSoilSaturationDay1, self.var.RiceFloodingDay1,
+                                             self.var.RicePlantingDay1, self.var.RiceGrowingEndDay1,
+                                             self.var.RiceDrainageDay1, self.var.RiceHarvestDay1)
+        # phase flags by day of the year and rice pixel: a single byte per pixel is read at each time step
+        self.active_phases = np.bitwise_or.reduce(self.phase_calendar, axis=1)
+        # phases in progress in at least one rice pixel, by day of the year
+        self.paddy_rice_abstraction.fill(0.)
+        # pixels without paddy rice are never written again: clear values left over from the previous rice pixels
+
     def dynamic(self):
         """ dynamic part of the rice irrigation routine
            inside the water abstraction routine
         """
         settings = LisSettings.instance()
         option = settings.options
-        maskinfo = MaskInfo.instance()
         if option['riceIrrigation']:
-            veg = "Rainfed_prescribed" # ONCE RICE IS SIMULATED IN EPIC, THIS MODULE SHOULD BE SKIPPED WHEN EPIC IS ON!
-            iveg, ilanduse, _ = self.var.get_landuse_and_indexes_from_vegetation_GLOBAL(veg)
- 
-            # water needed for paddy rice is assumed to consist of:
-            # phase 1: field preparation: soil saturation (assumed to happen in 10 days, 20 days before planting)
-            # phase 2: flood fields (assumed to happen in 10 days, 10 days before planting)
-            # phase 3: planting, while keep constant water level during growing season (open water evaporation)
-            # phase 4: stop keeping constant water level 20 days before harvest date
-            # phase 5: start draining 10 days before harvest date
-            
-            # ORIGINAL
-            #RiceSoilSaturationDemandM3 = (self.var.WS1[ilanduse] - self.var.W1[iveg] + self.var.WS2[ilanduse] - self.var.W2[iveg]) * self.var.RiceFraction * self.var.MMtoM3 * self.var.DtDay
-            # this part is using the whole other fraction to calculate the demand -> an rice only soil part is needed
-            # RiceIrrigationDemandM3 unit is m3 per time interval [m3/dt]
-            
-            # EDITED on Jan 15th 2022: saturation demand is computed considering only soil layers 1a and 1b (NO 2)
-            RiceSoilSaturationDemandM3 = (self.var.WS1.values[ilanduse] - self.var.W1.values[iveg]) * self.var.RiceFraction * self.var.MMtoM3 * self.var.DtDay
-            # this part is using the whole other fraction to calculate the demand -> an rice only soil part is needed
-            # RiceIrrigationDemandM3 unit is m3 per time interval [m3/dt]            
-
-            pl_20 = self.var.RicePlantingDay1 - 20
-            pl_20 = np.where(pl_20 < 0, 365 + pl_20, pl_20)
-            pl_10 = self.var.RicePlantingDay1 - 10
-            pl_10 = np.where(pl_10 < 0, 365 + pl_10, pl_10)
-
-            ha_20 = self.var.RiceHarvestDay1 - 20
-            ha_20 = np.where(ha_20 < 0, 365 + ha_20, ha_20)
-            ha_10 = self.var.RiceHarvestDay1 - 10
-            ha_10 = np.where(ha_10 < 0, 365 + ha_10, ha_10)
-            
- 
-            # for Europe ok, but for Global planting can be on the 330 and harvest on the 90, so harvest < planting
-            # or riceplanting = 5 => riceplanting -20 =350 ==> riceplanting < riceplanting -20
-
-            """ phase 1: field preparation: soil saturation (assumed to happen in 10 days, 20 days before planting)"""
-            RiceSoilSaturationM3 = np.where((self.var.CalendarDay >= pl_20) & (self.var.CalendarDay < pl_10),
-                                            0.1 * RiceSoilSaturationDemandM3, maskinfo.in_zero())
-
-            RiceEva = np.maximum(self.var.EWRef - (self.var.ESAct.values[iveg] + self.var.Ta.values[iveg]), 0)            
-            RiceEvaporationDemandM3 = RiceEva * self.var.RiceFraction * self.var.MMtoM3  # m3 per time interval
-            # should not happen, but just to be sure that this doesnt go <0
-            # part of the evaporation is already taken out in soil module!
-            # substracting the soil evaporation and transpiration which was already taken off in the soil module
-            
-            RiceFloodingDemandM3 = self.var.RiceFlooding * self.var.RiceFraction * self.var.MMtoM3 * self.var.DtDay  # m3 per time interval
-
-            """ phase 2: flood fields (assumed to happen in 10 days, 10 days before planting)"""
-
-            RiceFloodingM3 = np.where(
-                (self.var.CalendarDay >= pl_10) & (self.var.CalendarDay < self.var.RicePlantingDay1),
-                RiceFloodingDemandM3 + RiceEvaporationDemandM3, maskinfo.in_zero())  # m3 per time interval
-            # part of the evaporation is already taken out in soil module!
-            # assumption is that a fixed water layer is kept on the rice fields, totalling RiceFlooding*10 in mmm (typically 50 or 100 mm)
-            # application is spread out over 10 days
-            # open water evaporation at the same time
-
-            """ phase 3: planting, while keep constant water level during growing season (open water evaporation) """
-            RiceEvaporationM3 = np.where(
-                (self.var.CalendarDay >= self.var.RicePlantingDay1) & (self.var.CalendarDay < ha_20),
-                RiceEvaporationDemandM3, maskinfo.in_zero())  # m3 per time interval
-            # substracting the soil evaporation which was already taken off in the soil module (also transpitation should be tyaken off )
-
-            RicePercolationDemandM3 = self.var.RicePercolation * self.var.RiceFraction * self.var.MMtoM3 * self.var.DtDay  # m3 per time interval         
-            RicePercolationM3 = np.where(
-                (self.var.CalendarDay >= self.var.RicePlantingDay1) & (self.var.CalendarDay < ha_20),
-                RicePercolationDemandM3, maskinfo.in_zero())  # m3 per time interval
-            # FAO: percolation for heavy clay soils: PERC = 2 mm/day
-            
-            self.var.PaddyRiceWaterAbstractionFromSurfaceWaterM3 = RiceSoilSaturationM3 + RiceFloodingM3 + RiceEvaporationM3 + RicePercolationM3  # m3 per time interval
+            var = self.var
+            buffer = self.paddy_rice_abstraction
+            var.PaddyRiceWaterAbstractionFromSurfaceWaterM3 = buffer
             # m3 water needed for paddyrice
 
-            """# phase 4: stop keeping constant water level 20 days before harvest date
-                 phase 5: start draining 10 days before harvest date"""
-            # RiceDrainageM3=if((CalendarDay ge (RiceHarvestDay1-10)) and (CalendarDay le RiceHarvestDay1),(WS1-WFC1+WS2-WFC2)*RiceFraction*MMtoM3,0)
-
-            # ORIGINAL: DRAINAGE from all the soil layers
-            #RiceDrainageDemandM3 = (self.var.WS1[ilanduse] - self.var.WFC1[ilanduse] + self.var.WS2[ilanduse] - \
-            #   self.var.WFC2[ilanduse]) * self.var.RiceFraction * self.var.MMtoM3 * self.var.DtDay  # m3 per time interval
-            
-            # EDITED on January 15th 2022: DRAINAGE from layers 1a and 1b (NO 2)    
-            RiceDrainageDemandM3 = (self.var.WS1.values[ilanduse] - self.var.WFC1.values[ilanduse]) * self.var.RiceFraction * self.var.MMtoM3 * self.var.DtDay  # m3 per time interval    
-            
-            RiceDrainageM3 = np.where(
-                (self.var.CalendarDay >= ha_10) & (self.var.CalendarDay < self.var.RiceHarvestDay1),
-                0.1 * RiceDrainageDemandM3, maskinfo.in_zero())
-
-            # drainage until FC to soil/groundwater at end of season
-            # assumption that the last weeks before harvest the 50mm water layer is completely evaporating
-            # needs to be transported to channel system or being drained
-
-            self.var.UZ.values[iveg][:] += np.where(self.var.SoilFraction.values[iveg] > 0.0,
-                                       (RiceDrainageM3 + RicePercolationM3) * self.var.M3toMM / self.var.SoilFraction.values[iveg], ## OtherFraction
-                                       0.0)
-            # drained water is added to Upper Zone
-            
\ No newline at end of file
+            if var.RiceFraction is not self.rice_fraction:
+                self.update_rice_area()
+            if not self.active_phases[var.CalendarDay]:
+                # no rice pixel is in any paddy rice phase today: no abstraction and no drainage to the upper zone
+                # the buffer only needs clearing on the first inactive day after an active one
+                if self.paddy_rice_active:
+                    buffer.fill(0.)
+                    self.paddy_rice_active = False
+                return
+            self.paddy_rice_active = True
+
+            # bind the soil states of the paddy rice vegetation/land use once (one .values lookup each)
+            iveg, ilanduse = self.iveg, self.ilanduse
+            WS1 = var.WS1.values[ilanduse]
+            W1 = var.W1.values[iveg]
+            WFC1 = var.WFC1.values[ilanduse]
+            ESAct = var.ESAct.values[iveg]
+            Ta = var.Ta.values[iveg]
+            SoilFraction = var.SoilFraction.values[iveg]
+            UZ = var.UZ.values[iveg]
+            paddy_rice_water_balance(self.rice_pixels, self.phase_calendar[var.CalendarDay], WS1, W1, WFC1, var.EWRef, ESAct, Ta,
+                                     var.RiceMMtoM3, var.RiceMMtoM3Dt, var.RiceFloodingDemandM3, var.RicePercolationDemandM3,
+                                     var.M3toMM, SoilFraction, buffer, UZ)
+            # drained water is added to Upper Zone (in place)